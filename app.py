@@ -2,13 +2,44 @@
 # app.py (final) - UPDATED with Unified State Handling
 # ===============================
 
-from flask import Flask, request, jsonify
+from flask import Flask, request
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hmac
 import hashlib
+import functools
+import math
+import random
+import re
+import sched
+import sys
 import time
+import types
 import threading
+import json
 import os
+from collections import deque, namedtuple
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+try:
+    import websocket  # websocket-client; optional, REST polling is used without it
+except ImportError:
+    websocket = None
+
+try:
+    import orjson  # optional, 2-5x faster than stdlib json on Binance payloads
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    orjson = None
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":"))
 
 from config import *
 from trade_notifier import (
@@ -16,133 +47,571 @@ from trade_notifier import (
     log_trade_exit,
     trades,
     interval_to_seconds,
-    trades_lock,
+    trades_lock_for,
+    trades_set,
+    trades_setdefault,
+    trades_pop,
+    symbol_keys,
+    symbol_interval,
     send_telegram_message,
 )
 
 app = Flask(__name__)
 
+
+def json_response(payload, status=200):
+    """Compact JSON response without jsonify's provider dispatch / key sorting."""
+    return app.response_class(json_dumps(payload), status=status, mimetype="application/json")
+
 # -------------------------
 # Interval normalization map
 # -------------------------
-INTERVAL_MAP = {
+# Read-only, lowercase keys, with interned keys/values so composite trade keys reuse the same strings
+INTERVAL_MAP = types.MappingProxyType({sys.intern(k): sys.intern(v) for k, v in {
     "1": "1m", "3": "3m", "5": "5m", "15": "15m", "30": "30m",
-    "60": "1h", "120": "2h", "240": "4h", "1": "1m",
+    "60": "1h", "120": "2h", "240": "4h",
     "1m": "1m", "3m": "3m", "5m": "5m", "15m": "15m", "30m": "30m",
-    "1h": "1h", "2h": "2h", "4h": "4h", "1d": "1d", "D": "1d", "1D": "1d"
-}
+    "1h": "1h", "2h": "2h", "4h": "4h", "1d": "1d", "d": "1d"
+}.items()})
 
 
+@functools.lru_cache(maxsize=64)
 def normalize_interval(raw):
     if raw is None:
         return "1m"
-    key = str(raw).strip()
-    return INTERVAL_MAP.get(key, key).lower()
+    # exact hit (the usual TradingView "15" / "1h") skips strip/lower entirely
+    hit = INTERVAL_MAP.get(raw)
+    if hit is not None:
+        return hit
+    key = str(raw).strip().lower()
+    return INTERVAL_MAP.get(key) or sys.intern(key)
+
+
+@functools.lru_cache(maxsize=256)
+def canonical_symbol(ticker: str) -> str:
+    """TradingView ticker -> Binance USDT-M symbol (BTC / BTCUSDT -> BTCUSDT)."""
+    return ticker.replace("USDT", "") + "USDT"
+
+
+# ticker|comment|close|high|low|interval[|...] parsed and stripped in a single pass
+_WEBHOOK_RE = re.compile(
+    r"\s*([^|]*?)\s*\|\s*([^|]*?)\s*\|\s*([^|]*?)\s*\|\s*([^|]*?)\s*\|\s*([^|]*?)\s*\|\s*([^|]*?)\s*(?:\|.*)?",
+    re.S,
+)
 
 
 def trade_key(symbol: str, interval: str) -> str:
     """Canonical key used in shared trades dict (matches trade_notifier)."""
-    return f"{symbol}_{interval.lower()}"
+    return sys.intern(f"{symbol}_{interval.lower()}")
+
+
+def resolve_trade(symbol: str, interval: str) -> dict:
+    """Local trade for symbol/interval, else the plain-symbol fallback entry, else {}."""
+    return trades.get(trade_key(symbol, interval)) or trades.get(symbol) or {}
+
+
+# ===============================
+# 🌐 Shared HTTP Session (keep-alive + pooling)
+# ===============================
+# One pooled session for every Binance call so TLS handshakes are paid
+# once per connection instead of once per poll. Retry only covers idempotent
+# methods (urllib3 default), so order POSTs are never re-sent; transient gateway errors
+# (502/503/504) on GETs are retried too.
+HTTP_TIMEOUT = (3, 10)  # (connect, read) seconds
+
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504], raise_on_status=False),
+))
+# API key goes only on requests to Binance (never a session default, so it can't leak to
+# other hosts); built once and passed per call.
+BINANCE_HEADERS = {"X-MBX-APIKEY": BINANCE_API_KEY} if BINANCE_API_KEY else {}
+
+
+# ===============================
+# 🧵 Background Workers
+# ===============================
+# Bounded pools instead of one OS thread per event. Entry waiters can block for hours on a
+# resting limit order, so they get their own pool: time-critical jobs (2-bar force exits,
+# exit finalizers, scheduler jobs) on EXEC never queue behind them.
+EXEC = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="worker")
+ENTRY_WAITERS = ThreadPoolExecutor(max_workers=ENTRY_WAITER_THREADS, thread_name_prefix="entry-waiter")
+
+# Single timer thread for delayed jobs (2-bar checks); due jobs run on EXEC.
+_sched_wakeup = threading.Event()
+
+
+def _sched_delay(delay):
+    # interruptible sleep so a newly queued earlier job is not stuck behind a later one
+    if _sched_wakeup.wait(delay):
+        _sched_wakeup.clear()
+
+
+# monotonic clock: timers are unaffected by NTP steps / wall-clock jumps
+_SCHED = sched.scheduler(time.monotonic, _sched_delay)
+
+
+def schedule_in(delay, fn, *args):
+    """Run fn(*args) on EXEC after `delay` seconds (immediately if <= 0)."""
+    _SCHED.enter(max(delay, 0), 1, EXEC.submit, (fn, *args))
+    _sched_wakeup.set()  # wake the timer thread in case this job is due before its current sleep ends
+
+
+def _scheduler_loop():
+    while True:
+        _SCHED.run()
+        _sched_wakeup.wait()
+        _sched_wakeup.clear()
+
+
+threading.Thread(target=_scheduler_loop, name="scheduler", daemon=True).start()
+
+
+# ===============================
+# 🔁 Single-flight (collapse concurrent identical fetches)
+# ===============================
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def single_flight(key, fetch):
+    """
+    Run fetch() once for all concurrent callers with the same key; the others block and
+    share its result (or exception). Nothing is cached after the call completes.
+    """
+    with _inflight_lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _inflight[key] = {"event": threading.Event(), "result": None, "error": None}
+    if not leader:
+        call["event"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"]
+    try:
+        call["result"] = fetch()
+        return call["result"]
+    except Exception as e:
+        call["error"] = e
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        call["event"].set()
 
 
 # ===============================
 # 🔒 Binance Signed Request Helper
 # ===============================
+# Secret is encoded once and the HMAC key schedule (ipad/opad digests) computed once;
+# each signature copies it. The API key header dict (BINANCE_HEADERS) is shared, not rebuilt.
+_SECRET_BYTES = (BINANCE_SECRET_KEY or "").encode()
+_HMAC_TEMPLATE = hmac.new(_SECRET_BYTES, b"", hashlib.sha256)
+
+
+def sign(query: bytes) -> str:
+    """HMAC-SHA256 hex signature of an encoded query string with the Binance secret."""
+    h = _HMAC_TEMPLATE.copy()
+    h.update(query)
+    return h.hexdigest()
+
+
 def binance_signed_request(http_method, path, params=None):
-    if params is None:
-        params = {}
+    # copy so callers can keep one params dict per order and reuse it across polls
+    params = dict(params) if params else {}
     params["timestamp"] = int(time.time() * 1000)
-    # maintain given order (config/environment must be deterministic)
-    query = "&".join([f"{k}={v}" for k, v in params.items()])
-    signature = hmac.new(BINANCE_SECRET_KEY.encode(), query.encode(), hashlib.sha256).hexdigest()
-    query += f"&signature={signature}"
-    url = f"{BASE_URL}{path}?{query}"
-    headers = {"X-MBX-APIKEY": BINANCE_API_KEY}
+    # maintain given order (config/environment must be deterministic); values are
+    # percent-encoded so the signed bytes are exactly what Binance receives
+    query = urlencode(params, doseq=True)
+    url = f"{BASE_URL}{path}?{query}&signature={sign(query.encode())}"
+    if http_method not in ("POST", "DELETE"):
+        http_method = "GET"
     try:
-        if http_method == "POST":
-            return requests.post(url, headers=headers).json()
-        elif http_method == "DELETE":
-            return requests.delete(url, headers=headers).json()
-        else:
-            return requests.get(url, headers=headers).json()
+        return json_loads(SESSION.request(http_method, url, headers=BINANCE_HEADERS, timeout=HTTP_TIMEOUT).content)
     except Exception as e:
-        print("❌ Binance request failed:", e)
+        log.error(f"❌ Binance request failed: {e}", exc_info=True)
         return {"error": str(e)}
 
 
+# ===============================
+# 📡 User Data Stream (order updates pushed by Binance)
+# ===============================
+# order_id -> {"event": Event, "update": REST-shaped order dict, "symbol": set while a
+# waiter is registered, plus REST backoff state}. Slots are created by whichever side
+# arrives first (stream or waiter) so fills that land before the waiter registers are
+# not lost.
+order_slots = {}
+order_slots_lock = threading.Lock()
+MAX_ORDER_SLOTS = 1000
+stream_connected = threading.Event()
+listen_key = None
+
+
+def _order_slot(order_id, symbol=None):
+    order_id = str(order_id)
+    with order_slots_lock:
+        slot = order_slots.get(order_id)
+        if slot is None:
+            slot = order_slots[order_id] = {
+                "event": threading.Event(), "update": None, "symbol": None, "attempt": 0, "next_poll": 0.0,
+            }
+            # drop oldest slots nobody is waiting on (e.g. manual orders)
+            if len(order_slots) > MAX_ORDER_SLOTS:
+                for stale in [k for k, v in order_slots.items() if not v["symbol"]][:len(order_slots) - MAX_ORDER_SLOTS]:
+                    order_slots.pop(stale, None)
+        if symbol and not slot["symbol"]:
+            slot["symbol"] = symbol
+        return slot
+
+
+def release_order_slot(order_id):
+    with order_slots_lock:
+        order_slots.pop(str(order_id), None)
+
+
+def _publish_order_update(order_id, update):
+    """Store the latest order state and wake its waiter (only when something changed)."""
+    slot = _order_slot(order_id)
+    with order_slots_lock:
+        prev = slot["update"]
+        if prev and prev.get("status") == update.get("status") and prev.get("executedQty") == update.get("executedQty"):
+            return
+        slot["update"] = update
+        slot["event"].set()
+    if update.get("status") in ("PARTIALLY_FILLED", "FILLED"):
+        invalidate_positions()
+
+
+def _poll_sleep(attempt):
+    """REST poll backoff: 0.25s, 0.5s, 1s, then 2s cap, plus a little jitter."""
+    return min(0.25 * (2 ** attempt), 2.0) + random.random() * 0.05
+
+
+def wait_order_update(symbol, order_id, timeout=ORDER_STREAM_FALLBACK_SEC, params=None):
+    """
+    Block until the next update for order_id and return it in /fapi/v1/order shape.
+    Updates come from the user data stream, or from order_status_poller while the stream
+    is down. If neither reports a change within `timeout` seconds, query the order directly
+    (with the caller's {"symbol", "orderId"} params when given).
+    """
+    slot = _order_slot(order_id, symbol)
+    if slot["event"].wait(timeout):
+        with order_slots_lock:
+            slot["event"].clear()
+            if slot["update"]:
+                return dict(slot["update"])
+    return binance_signed_request("GET", "/fapi/v1/order", params or {"symbol": symbol, "orderId": order_id})
+
+
+def _poll_symbol_orders(symbol, order_ids):
+    # one signed call covers every open order we wait on for this symbol; orders missing
+    # from it reached a final state and get a single direct lookup
+    open_orders = binance_signed_request("GET", "/fapi/v1/openOrders", {"symbol": symbol})
+    if not isinstance(open_orders, list):
+        return
+    by_id = {str(o.get("orderId")): o for o in open_orders}
+    for order_id in order_ids:
+        update = by_id.get(order_id) or binance_signed_request("GET", "/fapi/v1/order", {"symbol": symbol, "orderId": order_id})
+        if isinstance(update, dict) and update.get("status"):
+            _publish_order_update(order_id, update)
+
+
+def order_status_poller():
+    """REST fallback while the user data stream is down: one coalesced tick for all waiters."""
+    while True:
+        time.sleep(ORDER_POLL_INTERVAL)
+        if stream_connected.is_set():
+            continue
+        now = time.time()
+        due = {}
+        with order_slots_lock:
+            for order_id, slot in order_slots.items():
+                if slot["symbol"] and slot["next_poll"] <= now:
+                    due.setdefault(slot["symbol"], []).append(order_id)
+                    # per-order backoff so long-resting GTC orders are polled less often
+                    slot["next_poll"] = now + _poll_sleep(slot["attempt"])
+                    slot["attempt"] += 1
+        for symbol, order_ids in due.items():
+            try:
+                _poll_symbol_orders(symbol, order_ids)
+            except Exception as e:
+                log.error(f"❌ order_status_poller error for {symbol}: {e}", exc_info=True)
+
+
+def _on_user_data_message(ws, message):
+    try:
+        event = json_loads(message)
+        event_type = event.get("e")
+        if event_type == "listenKeyExpired":
+            log.warning("⚠️ [WS] listenKey expired → reconnecting user data stream")
+            ws.close()
+            return
+        if event_type != "ORDER_TRADE_UPDATE":
+            return
+        o = event.get("o", {})
+        _publish_order_update(o.get("i"), {
+            "symbol": o.get("s"),
+            "orderId": o.get("i"),
+            "status": o.get("X"),
+            "executedQty": o.get("z"),
+            "avgPrice": o.get("ap"),
+            "price": o.get("p"),
+        })
+    except Exception as e:
+        log.error(f"❌ [WS] user data message error: {e}", exc_info=True)
+
+
+def _on_user_data_open(ws):
+    stream_connected.set()
+    log.info("[WS] User data stream connected")
+
+
+def _on_user_data_close(ws, status_code=None, msg=None):
+    stream_connected.clear()
+    log.info(f"[WS] User data stream closed ({status_code}) → falling back to REST polling")
+
+
+def _on_user_data_error(ws, error):
+    log.warning(f"⚠️ [WS] User data stream error: {error}")
+
+
+def listen_key_keepalive():
+    """Extend the current listenKey; Binance drops it after 60 minutes without a PUT."""
+    while True:
+        time.sleep(LISTEN_KEY_KEEPALIVE_SEC)
+        if not listen_key:
+            continue
+        try:
+            SESSION.put(f"{BASE_URL}/fapi/v1/listenKey", headers=BINANCE_HEADERS, timeout=HTTP_TIMEOUT)
+        except Exception as e:
+            log.warning(f"⚠️ [WS] listenKey keepalive failed: {e}")
+
+
+def user_data_stream():
+    """Keep one websocket open to the futures user data stream, reconnecting on drop."""
+    global listen_key
+    while True:
+        try:
+            listen_key = json_loads(SESSION.post(f"{BASE_URL}/fapi/v1/listenKey", headers=BINANCE_HEADERS, timeout=HTTP_TIMEOUT).content).get("listenKey")
+            if not listen_key:
+                log.warning("⚠️ [WS] Could not obtain listenKey; retrying in 30s")
+                time.sleep(30)
+                continue
+            ws = websocket.WebSocketApp(
+                f"{WS_BASE_URL}/ws/{listen_key}",
+                on_open=_on_user_data_open,
+                on_message=_on_user_data_message,
+                on_error=_on_user_data_error,
+                on_close=_on_user_data_close,
+            )
+            ws.run_forever(ping_interval=60, ping_timeout=10)
+        except Exception as e:
+            log.error(f"❌ [WS] user_data_stream error: {e}", exc_info=True)
+        stream_connected.clear()
+        time.sleep(5)
+
+
 # ===============================
 # ⚙️ Leverage & Margin Setup
 # ===============================
+# Binance keeps leverage / margin type per symbol across trades: configure each symbol once
+# per process instead of two signed POSTs on every entry.
+_configured_symbols = set()
+
+
 def set_leverage_and_margin(symbol):
+    if symbol in _configured_symbols:
+        return
     try:
-        binance_signed_request("POST", "/fapi/v1/leverage", {"symbol": symbol, "leverage": LEVERAGE})
-        binance_signed_request("POST", "/fapi/v1/marginType", {"symbol": symbol, "marginType": MARGIN_TYPE})
+        # runs once per symbol per process: plain sequential calls, no dependency on a worker pool
+        lev = binance_signed_request("POST", "/fapi/v1/leverage", {"symbol": symbol, "leverage": LEVERAGE})
+        margin = binance_signed_request("POST", "/fapi/v1/marginType", {"symbol": symbol, "marginType": MARGIN_TYPE})
+        # -4046 = "No need to change margin type" (already set) counts as success
+        if "leverage" in lev and (margin.get("code") in (200, -4046)):
+            _configured_symbols.add(symbol)
     except Exception as e:
-        print("❌ Failed to set leverage/margin:", e)
+        log.error(f"❌ Failed to set leverage/margin: {e}", exc_info=True)
 
 
 # ===============================
 # 📊 Quantity & Position Helpers
 # ===============================
-def get_symbol_info(symbol):
-    info = requests.get(f"{BASE_URL}/fapi/v1/exchangeInfo").json()
+# exchangeInfo is several MB; pre-parse the filters we use once and refresh on a long TTL
+# step_units / qty_scale express stepSize as an exact integer lot: step_size == step_units / qty_scale
+SymbolFilters = namedtuple("SymbolFilters", "step_size min_qty tick_size step_units qty_scale")
+_SYMBOL_CACHE = {}          # symbol -> SymbolFilters
+_SYMBOL_CACHE_TS = 0
+_SYMBOL_CACHE_TTL = 3600    # seconds
+_SYMBOL_RELOAD_MIN_GAP = 60  # unknown symbol / failed load: don't refetch more often than this
+_symbol_cache_attempt_ts = 0
+_symbol_cache_lock = threading.Lock()
+
+_PRICE_CACHE = {}           # symbol -> (fetched_at, price)
+_PRICE_CACHE_TTL = 0.5      # seconds; absorbs bursts of alerts on the same symbol
+
+
+def _load_symbol_filters():
+    global _SYMBOL_CACHE, _SYMBOL_CACHE_TS
+    info = json_loads(SESSION.get(f"{BASE_URL}/fapi/v1/exchangeInfo", timeout=HTTP_TIMEOUT).content)
+    filters = {}
     for s in info.get("symbols", []):
-        if s["symbol"] == symbol:
-            return s
-    return None
+        lot = price = None
+        for f in s.get("filters", []):
+            if f.get("filterType") == "LOT_SIZE":
+                lot = f
+            elif f.get("filterType") == "PRICE_FILTER":
+                price = f
+        if lot:
+            tick_size = float(price["tickSize"]) if price else 0.0
+            step = Decimal(lot["stepSize"])
+            qty_scale = 10 ** max(0, -step.normalize().as_tuple().exponent)
+            filters[s["symbol"]] = SymbolFilters(
+                float(step), float(lot["minQty"]), tick_size, int(step * qty_scale), qty_scale,
+            )
+    if filters:
+        _SYMBOL_CACHE = filters
+        _SYMBOL_CACHE_TS = time.time()
+
+
+def _symbol_cache_needs_reload(symbol):
+    now = time.time()
+    if now - _symbol_cache_attempt_ts < _SYMBOL_RELOAD_MIN_GAP:
+        return False
+    return now - _SYMBOL_CACHE_TS > _SYMBOL_CACHE_TTL or symbol not in _SYMBOL_CACHE
+
+
+def get_symbol_filters(symbol):
+    """Return cached SymbolFilters for symbol, reloading exchangeInfo when stale."""
+    global _symbol_cache_attempt_ts
+    if _symbol_cache_needs_reload(symbol):
+        with _symbol_cache_lock:
+            # re-check: another thread may have refreshed while we waited
+            if _symbol_cache_needs_reload(symbol):
+                _symbol_cache_attempt_ts = time.time()
+                try:
+                    _load_symbol_filters()
+                except Exception as e:
+                    log.error(f"❌ Failed to load exchangeInfo: {e}", exc_info=True)
+    return _SYMBOL_CACHE.get(symbol)
+
+
+def _round_qty_core(qty: float, step_units: int, qty_scale: int, min_qty: float) -> float:
+    """
+    Floor qty to a whole number of lots, clamped up to min_qty (pure arithmetic, no lookups).
+    Works in integer units of 1/qty_scale: float division (0.3 / 0.1 == 2.999...) would
+    otherwise drop a lot and send an undersized order.
+    """
+    if step_units <= 0:
+        return max(qty, min_qty)
+    units = math.floor(round(qty * qty_scale, 6))  # round() absorbs binary FP noise below one unit
+    q = (units // step_units) * step_units / qty_scale
+    return q if q >= min_qty else min_qty
 
 
 def round_quantity(symbol, qty):
-    info = get_symbol_info(symbol)
-    if not info:
+    filters = get_symbol_filters(symbol)
+    if not filters:
         return round(qty, 3)
-    step_size = float([f["stepSize"] for f in info["filters"] if f["filterType"] == "LOT_SIZE"][0])
-    min_qty = float([f["minQty"] for f in info["filters"] if f["filterType"] == "LOT_SIZE"][0])
-    # Align to step_size (floor)
-    try:
-        multiples = int(qty / step_size)
-        qty = float(multiples * step_size)
-    except Exception:
-        qty = float(step_size)
-    if qty < min_qty:
-        qty = min_qty
-    return round(qty, 8)
+    return round(_round_qty_core(qty, filters.step_units, filters.qty_scale, filters.min_qty), 8)
+
+
+def round_price(symbol, price):
+    """Snap a limit price to the symbol's tickSize (Binance rejects off-tick prices)."""
+    filters = get_symbol_filters(symbol)
+    if not filters or filters.tick_size <= 0:
+        return price
+    return round(round(price / filters.tick_size) * filters.tick_size, 8)
+
+
+# ------------------------------
+# positionRisk memo: one entry -> replace -> new-entry flow (and CROSS/EXIT handling) reads
+# positions several times within a few hundred ms. Keep one account-wide snapshot and
+# filter it per symbol locally, so every reader shares one signed call (same weight as
+# a single-symbol query).
+# ------------------------------
+_POS_CACHE = None       # (fetched_at, positions list for all symbols)
+_POS_CACHE_TTL = 0.25   # seconds
+_pos_generation = 0     # bumped on invalidation so callers never join a pre-order fetch
+
+
+def get_positions(symbol=None, ttl=_POS_CACHE_TTL):
+    """/fapi/v2/positionRisk rows for symbol (or all symbols), from a snapshot reused for `ttl` seconds."""
+    global _POS_CACHE
+    now = time.monotonic()
+    cached = _POS_CACHE
+    if cached and now - cached[0] < ttl:
+        data = cached[1]
+    else:
+        gen = _pos_generation
+        data = single_flight(
+            ("positionRisk", gen),
+            lambda: binance_signed_request("GET", "/fapi/v2/positionRisk"),
+        )
+        if not isinstance(data, list):
+            return data  # error payload; never cached
+        # a fetch that started before invalidate_positions() holds a pre-order snapshot:
+        # return it to this caller, but don't let it repopulate the cache
+        if gen == _pos_generation:
+            _POS_CACHE = (now, data)
+    if symbol is None:
+        return data
+    return [p for p in data if p.get("symbol") == symbol]
+
+
+def invalidate_positions():
+    """Drop the memoized snapshot after an order is placed/filled so the next read is fresh."""
+    global _POS_CACHE, _pos_generation
+    _POS_CACHE = None
+    _pos_generation += 1
 
 
 def count_active_trades():
     try:
-        positions = binance_signed_request("GET", "/fapi/v2/positionRisk")
+        positions = get_positions()
         if isinstance(positions, dict) and positions.get("error"):
             return 0
-        active_positions = [p for p in positions if abs(float(p.get("positionAmt", 0))) > 0]
-        return len(active_positions)
+        # callers only compare against MAX_ACTIVE_TRADES: stop counting once it is reached
+        count = 0
+        for p in positions:
+            if float(p.get("positionAmt", 0)) != 0:
+                count += 1
+                if count >= MAX_ACTIVE_TRADES:
+                    break
+        return count
     except Exception as e:
-        print("❌ Failed to fetch active trades:", e)
+        log.error(f"❌ Failed to fetch active trades: {e}", exc_info=True)
         return 0
 
 
-def calculate_quantity(symbol):
+def calculate_quantity(symbol, ref_price=None):
+    """Size TRADE_AMOUNT * LEVERAGE in base units at ref_price (the alert's close), else the ticker price."""
     try:
-        price_data = requests.get(f"{BASE_URL}/fapi/v1/ticker/price", params={"symbol": symbol}).json()
-        price = float(price_data["price"])
+        cached = None if ref_price else _PRICE_CACHE.get(symbol)
+        if ref_price and ref_price > 0:
+            price = float(ref_price)
+        elif cached and time.time() - cached[0] < _PRICE_CACHE_TTL:
+            price = cached[1]
+        else:
+            price_data = single_flight(("ticker", symbol), lambda: json_loads(
+                SESSION.get(f"{BASE_URL}/fapi/v1/ticker/price", params={"symbol": symbol}, timeout=HTTP_TIMEOUT).content
+            ))
+            price = float(price_data["price"])
+            _PRICE_CACHE[symbol] = (time.time(), price)
         position_value = TRADE_AMOUNT * LEVERAGE
         qty = position_value / price
         return round_quantity(symbol, qty)
     except Exception as e:
-        print("❌ Failed to calculate quantity:", e)
+        log.error(f"❌ Failed to calculate quantity: {e}", exc_info=True)
         return 0.001
 
 
 def get_position_info(symbol):
-    # Signed endpoint
-    timestamp = int(time.time() * 1000)
-    query_string = f"timestamp={timestamp}&symbol={symbol}"
-    signature = hmac.new(BINANCE_SECRET_KEY.encode(), query_string.encode(), hashlib.sha256).hexdigest()
-    headers = {"X-MBX-APIKEY": BINANCE_API_KEY}
-    url = f"{BASE_URL}/fapi/v2/positionRisk?{query_string}&signature={signature}"
-    resp = requests.get(url, headers=headers)
-    if resp.status_code == 200 and isinstance(resp.json(), list) and len(resp.json()) > 0:
-        return resp.json()[0]
+    positions = get_positions(symbol)
+    if isinstance(positions, list) and positions:
+        return positions[0]
     return None
 
 
@@ -166,12 +635,11 @@ def compute_implied_pnl_dollar(entry_price, exit_price, position_qty, side):
 # ===============================
 def reset_2bar_state(symbol: str):
     """Reset 2-bar and unrealized loss tracking for a given symbol (clears fallback keys too)."""
-    with trades_lock:
+    with trades_lock_for(symbol):
         # remove keyed entries that belong to symbol (both interval keys and plain symbol fallback)
-        keys_to_remove = [k for k in list(trades.keys()) if k.startswith(f"{symbol}_") or k == symbol]
-        for k in keys_to_remove:
-            trades.pop(k, None)
-        print(f"[RESET] Cleared 2-bar and local state for {symbol}")
+        for k in symbol_keys(symbol):
+            trades_pop(symbol, k)
+        log.info(f"[RESET] Cleared 2-bar and local state for {symbol}")
 
 
 # ===============================
@@ -190,45 +658,31 @@ def finalize_trade(symbol, reason):
       - call reset_2bar_state to remove all local 2-bar tracking and fallback keys
     """
     try:
-        # determine interval from local state if any
-        found_interval = "1m"
-        with trades_lock:
-            for k in list(trades.keys()):
-                if k.startswith(f"{symbol}_"):
-                    found_interval = k.split("_", 1)[1]
-                    break
-
-        interval = found_interval
+        # determine interval and local entry (if any) in one pass under the lock; the trade
+        # dict is only read after userTrades returns
+        with trades_lock_for(symbol):
+            interval = symbol_interval(symbol, "1m")
+            local_trade = resolve_trade(symbol, interval)
 
         # Signed request to userTrades
-        timestamp = int(time.time() * 1000)
-        query_string = f"symbol={symbol}&timestamp={timestamp}"
-        signature = hmac.new(BINANCE_SECRET_KEY.encode(), query_string.encode(), hashlib.sha256).hexdigest()
-        headers = {"X-MBX-APIKEY": BINANCE_API_KEY}
-
-        url = f"{BASE_URL}/fapi/v1/userTrades?{query_string}&signature={signature}"
-        resp = requests.get(url, headers=headers)
-        if resp.status_code != 200:
-            print(f"⚠️ Binance trade fetch failed for {symbol}: {resp.text}")
+        trade_data = binance_signed_request("GET", "/fapi/v1/userTrades", {"symbol": symbol})
+        if not isinstance(trade_data, list):
+            log.warning(f"⚠️ Binance trade fetch failed for {symbol}: {trade_data}")
             # still attempt cleanup of local keys to avoid stale state
             reset_2bar_state(symbol)
             return
 
-        trade_data = resp.json()
         if not trade_data:
-            print(f"⚠️ No recent trade data for {symbol}")
+            log.warning(f"⚠️ No recent trade data for {symbol}")
             reset_2bar_state(symbol)
             return
 
         last_trade = trade_data[-1]
+        now = time.time()  # one clock read for the fallback order id / entry time below
         filled_price = float(last_trade.get("price", 0.0))
         realized_pnl = float(last_trade.get("realizedPnl", 0.0))
         qty = float(last_trade.get("qty", 0.0))
 
-        # try to get local entry price to compute percent and to include in exit message
-        with trades_lock:
-            local_trade = trades.get(trade_key(symbol, interval), {}) or trades.get(symbol, {}) or {}
-
         # Ensure there's a fallback local trade record so log_trade_exit() will always have an entry to read.
         # If no local entry_price, try to get Binance position 'entryPrice' as fallback.
         fallback_entry_price = filled_price
@@ -239,23 +693,25 @@ def finalize_trade(symbol, reason):
         except Exception:
             pass
 
-        with trades_lock:
-            if not local_trade:
-                # create minimal fallback so trade_notifier.log_trade_exit will not bail out
-                fallback_key = trade_key(symbol, interval)
-                trades[fallback_key] = {
-                    "symbol": symbol,
-                    "side": last_trade.get("side", "BUY") if isinstance(last_trade.get("side", None), str) else "BUY",
-                    "entry_price": fallback_entry_price,
-                    "order_id": last_trade.get("orderId") or f"auto_{int(time.time())}",
-                    "interval": interval,
-                    "closed": False,
-                    "entry_time": time.time() - 1
-                }
-                local_trade = trades[fallback_key]
-
-            entry_price = local_trade.get("entry_price", fallback_entry_price)
-            order_id = local_trade.get("order_id", last_trade.get("orderId") or f"auto_{int(time.time())}")
+        if not local_trade:
+            # create minimal fallback so trade_notifier.log_trade_exit will not bail out
+            # (built outside the lock; only the insert happens under it)
+            fallback_key = trade_key(symbol, interval)
+            fallback_trade = {
+                "symbol": symbol,
+                "side": last_trade.get("side", "BUY") if isinstance(last_trade.get("side", None), str) else "BUY",
+                "entry_price": fallback_entry_price,
+                "order_id": last_trade.get("orderId") or f"auto_{int(now)}",
+                "interval": interval,
+                "closed": False,
+                "entry_time": now - 1
+            }
+            with trades_lock_for(symbol):
+                trades_set(symbol, fallback_key, fallback_trade)
+            local_trade = fallback_trade
+
+        entry_price = local_trade.get("entry_price", fallback_entry_price)
+        order_id = local_trade.get("order_id", last_trade.get("orderId") or f"auto_{int(now)}")
 
         # Compute PnL absolute and percent consistently using realized_pnl and qty
         pnl = round(realized_pnl, 2)
@@ -268,15 +724,16 @@ def finalize_trade(symbol, reason):
             pnl_percent = 0.0
 
         # call trade_notifier's log_trade_exit()
-        log_trade_exit(symbol, filled_price, pnl, pnl_percent, reason=reason, interval=interval, order_id=order_id)
+        log_trade_exit(symbol, filled_price, pnl, pnl_percent, reason=reason, interval=interval, order_id=order_id,
+                       fallback_entry_price=entry_price)
 
-        print(f"[EXIT] {symbol} closed | {reason} | Exit: {filled_price} | PnL: {pnl} ({pnl_percent}%)")
+        log.info(f"[EXIT] {symbol} closed | {reason} | Exit: {filled_price} | PnL: {pnl} ({pnl_percent}%)")
 
         # cleanup local state entries that match symbol (both interval keys and fallback)
         reset_2bar_state(symbol)
 
     except Exception as e:
-        print(f"❌ finalize_trade() error for {symbol}: {e}")
+        log.error(f"❌ finalize_trade() error for {symbol}: {e}", exc_info=True)
         # best-effort cleanup on exception
         reset_2bar_state(symbol)
 
@@ -285,7 +742,7 @@ def finalize_trade(symbol, reason):
 # 🧾 Exit Handlers
 # ===============================
 def get_exit_qty(symbol):
-    pos_data = binance_signed_request("GET", "/fapi/v2/positionRisk", {"symbol": symbol})
+    pos_data = get_positions(symbol)
     if not pos_data:
         return 0
     try:
@@ -304,21 +761,20 @@ def execute_exit(symbol, side, interval="1m", bar_high=None, bar_low=None, reaso
     NOTE: This function expects the trade entry to already be "filled" in local state.
     """
     try:
-        key = trade_key(symbol, interval)
-        with trades_lock:
-            t = trades.get(key) or trades.get(symbol)
-            # if no local filled entry exists, still allow closure (user may want forced market close)
-            if not t:
-                print(f"[WARN] execute_exit: no local trade state for {symbol} (interval={interval}); proceeding to exit anyway.")
+        # single dict reads are atomic: no lock needed just to check presence
+        t = resolve_trade(symbol, interval)
+        # if no local filled entry exists, still allow closure (user may want forced market close)
+        if not t:
+            log.warning(f"[WARN] execute_exit: no local trade state for {symbol} (interval={interval}); proceeding to exit anyway.")
 
         if EXIT_MARKET_DELAY_ENABLED:
-            print(f"[{symbol}] Exit delay active → waiting {EXIT_MARKET_DELAY}s...")
+            log.info(f"[{symbol}] Exit delay active → waiting {EXIT_MARKET_DELAY}s...")
             time.sleep(EXIT_MARKET_DELAY)
 
         # Attempt bar high/low limit exit if configured and provided
         if USE_BAR_HIGH_LOW_FOR_EXIT and bar_high and bar_low:
-            limit_price = float(bar_high) if side.upper() == "BUY" else float(bar_low)
-            print(f"[{symbol}] Attempting limit exit @ {limit_price} ({side})")
+            limit_price = round_price(symbol, float(bar_high) if side.upper() == "BUY" else float(bar_low))
+            log.info(f"[{symbol}] Attempting limit exit @ {limit_price} ({side})")
 
             limit_order = binance_signed_request("POST", "/fapi/v1/order", {
                 "symbol": symbol,
@@ -326,112 +782,151 @@ def execute_exit(symbol, side, interval="1m", bar_high=None, bar_low=None, reaso
                 "type": "LIMIT",
                 "timeInForce": "GTC",
                 "quantity": get_exit_qty(symbol),
-                "price": limit_price
+                "price": limit_price,
+                "reduceOnly": "true",  # a copy that survives a failed cancel can never open a reverse position
             })
 
-            order_id = limit_order.get("orderId")
+            order_id = limit_order.get("orderId") if isinstance(limit_order, dict) else None
+            if order_id is None:
+                # rejected (e.g. reduceOnly / filter error): nothing to wait on or cancel
+                log.error(f"❌ Limit exit rejected for {symbol}: {limit_order} → switching to MARKET exit")
+                execute_market_exit(symbol, side, reason=reason)
+                return True
             start_time = time.time()
-
-            while time.time() - start_time < BAR_EXIT_TIMEOUT_SEC:
-                order_status = binance_signed_request("GET", "/fapi/v1/order", {
-                    "symbol": symbol,
-                    "orderId": order_id
-                })
-                if order_status.get("status") == "FILLED":
-                    print(f"[EXIT] {symbol} filled @ {limit_price}")
-                    finalize_trade(symbol, reason=reason)
-                    return True
-                time.sleep(1)
-
-            print(f"[{symbol}] Limit not filled in {BAR_EXIT_TIMEOUT_SEC}s → switching to MARKET exit")
+            invalidate_positions()
+
+            order_params = {"symbol": symbol, "orderId": order_id}
+            try:
+                order_status = binance_signed_request("GET", "/fapi/v1/order", order_params)
+                while True:
+                    if order_status.get("status") == "FILLED":
+                        log.info(f"[EXIT] {symbol} filled @ {limit_price}")
+                        finalize_trade(symbol, reason=reason)
+                        return True
+                    remaining = BAR_EXIT_TIMEOUT_SEC - (time.time() - start_time)
+                    if remaining <= 0:
+                        break
+                    order_status = wait_order_update(symbol, order_id, remaining, order_params)
+
+                # Pull the resting limit before going to market; left on the book it could still
+                # fill after the market close and open a reverse position. If the cancel fails
+                # the order most likely filled in the meantime.
+                cancel = binance_signed_request("DELETE", "/fapi/v1/order", order_params)
+                if cancel.get("status") != "CANCELED":
+                    if binance_signed_request("GET", "/fapi/v1/order", order_params).get("status") == "FILLED":
+                        log.info(f"[EXIT] {symbol} filled @ {limit_price}")
+                        finalize_trade(symbol, reason=reason)
+                        return True
+                invalidate_positions()  # a partial fill shrank the position; size the market close fresh
+            finally:
+                release_order_slot(order_id)
+
+            log.info(f"[{symbol}] Limit not filled in {BAR_EXIT_TIMEOUT_SEC}s → switching to MARKET exit")
 
         # Market fallback
         execute_market_exit(symbol, side, reason=reason)
         return True
 
     except Exception as e:
-        print(f"❌ Exit error for {symbol}: {e}")
+        log.error(f"❌ Exit error for {symbol}: {e}", exc_info=True)
         return False
 
 
+_symbol_locks = {}
+
+
+def symbol_lock(symbol):
+    """Per-symbol lock serializing market closes (dict.setdefault is atomic under the GIL)."""
+    return _symbol_locks.get(symbol) or _symbol_locks.setdefault(symbol, threading.Lock())
+
+
 def execute_market_exit(symbol, side, reason="Market Exit"):
-    pos_data = binance_signed_request("GET", "/fapi/v2/positionRisk", {"symbol": symbol})
-    if not pos_data or abs(float(pos_data[0].get("positionAmt", 0))) == 0:
-        print(f"⚠️ No active position for {symbol}")
-        # Clear local state if mismatch (but do not preemptively reset if user intended another flow)
-        # Only reset here to keep cleanup consistent
-        reset_2bar_state(symbol)
-        return {"status": "no_position"}
+    # CROSS / OPPOSITE / SAME / EXIT / 2-BAR can fire together: only one close per symbol at
+    # a time, and reduceOnly guarantees a late duplicate can never open a reverse position.
+    with symbol_lock(symbol):
+        pos_data = get_positions(symbol)
+        if not pos_data or abs(float(pos_data[0].get("positionAmt", 0))) == 0:
+            log.warning(f"⚠️ No active position for {symbol}")
+            # Clear local state if mismatch (but do not preemptively reset if user intended another flow)
+            # Only reset here to keep cleanup consistent
+            reset_2bar_state(symbol)
+            return {"status": "no_position"}
 
-    qty = abs(float(pos_data[0].get("positionAmt", 0)))
-    qty = round_quantity(symbol, qty)
-    close_side = "SELL" if side.upper() == "BUY" else "BUY"
+        qty = abs(float(pos_data[0].get("positionAmt", 0)))
+        qty = round_quantity(symbol, qty)
+        close_side = "SELL" if side.upper() == "BUY" else "BUY"
 
-    response = binance_signed_request("POST", "/fapi/v1/order", {
-        "symbol": symbol,
-        "side": close_side,
-        "type": "MARKET",
-        "quantity": qty
-    })
+        response = binance_signed_request("POST", "/fapi/v1/order", {
+            "symbol": symbol,
+            "side": close_side,
+            "type": "MARKET",
+            "quantity": qty,
+            "reduceOnly": "true",
+        })
 
-    if isinstance(response, dict) and "orderId" in response:
-        threading.Thread(target=wait_and_finalize_exit, args=(symbol, response["orderId"], reason), daemon=True).start()
+        if isinstance(response, dict) and "orderId" in response:
+            invalidate_positions()
+            EXEC.submit(wait_and_finalize_exit, symbol, response["orderId"], reason)
 
     return response
 
 
 def wait_and_finalize_exit(symbol, order_id, reason):
-    while True:
-        order_status = binance_signed_request("GET", "/fapi/v1/order", {"symbol": symbol, "orderId": order_id})
-        if isinstance(order_status, dict) and order_status.get("status") == "FILLED":
-            finalize_trade(symbol, reason)
-            break
-        time.sleep(1)
+    deadline = time.time() + EXIT_ORDER_TIMEOUT_SEC
+    order_params = {"symbol": symbol, "orderId": order_id}
+    try:
+        order_status = binance_signed_request("GET", "/fapi/v1/order", order_params)
+        while True:
+            status = order_status.get("status") if isinstance(order_status, dict) else None
+            if status == "FILLED":
+                finalize_trade(symbol, reason)
+                break
+            if status in ("CANCELED", "REJECTED", "EXPIRED"):
+                # e.g. a duplicate reduceOnly close after the position was already flat
+                log.warning(f"⚠️ Exit order {order_id} for {symbol} ended {status}; not finalizing.")
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                log.warning(f"⚠️ Exit order {order_id} for {symbol} not FILLED after {EXIT_ORDER_TIMEOUT_SEC}s → finalizing from trade history.")
+                finalize_trade(symbol, f"{reason} (Timeout)")
+                break
+            order_status = wait_order_update(symbol, order_id, min(remaining, ORDER_STREAM_FALLBACK_SEC), order_params)
+    finally:
+        release_order_slot(order_id)
 
 
 # ===============================
 # ⏱️ 2-Bar Exit Logic (force market exit after 2 bars)
 # ===============================
+def schedule_two_bar_check(symbol, interval_str, start_time=None):
+    """
+    Queue two_bar_force_exit_worker for 2 bars (2 * interval_seconds) after start_time:
+    the TradingView entry alert (bar_start_time), or the fill time as fallback.
+    Safe to call while holding trades_lock_for(symbol).
+    """
+    # start_time is wall-clock (stored on the trade); convert to a delay once, then wait monotonic
+    start_time = start_time or time.time()
+    delay = start_time + 2 * interval_to_seconds(interval_str) - time.time()
+    schedule_in(delay, two_bar_force_exit_worker, symbol, interval_str)
+
+
 def two_bar_force_exit_worker(symbol, interval_str):
     """
-    Worker that waits for 2 bars (2 * interval_seconds) after the TradingView entry alert
-    (bar_start_time), then conditionally force-closes at market:
+    Runs 2 bars after the TradingView entry alert (see schedule_two_bar_check), then
+    conditionally force-closes at market:
       - If unrealized PnL is negative -> force market exit (2-bar forced)
       - If unrealized PnL is >= 0 -> keep position open (do nothing)
     The worker will skip forcing if an exit signal arrived and set the local flag 'exit_signal_received'.
     """
     try:
-        interval_seconds = interval_to_seconds(interval_str)
-        key = trade_key(symbol, interval_str)
-
-        # Use bar_start_time (set at entry alert) if available; fall back to entry_time (fill)
-        with trades_lock:
-            trade = trades.get(key) or trades.get(symbol)
-            if not trade:
-                return
-            bar_start_time = trade.get("bar_start_time")
-            entry_time = trade.get("entry_time", time.time())
-
-        start_time = bar_start_time or entry_time or time.time()
-
-        # Sleep until 2 bars after the bar_start_time (or entry_time fallback)
-        target = start_time + (2 * interval_seconds)
-        now = time.time()
-        remaining = target - now
-        if remaining > 0:
-            time.sleep(remaining)
-
         # Re-check local trade: if exit_signal_received is set, skip 2-bar logic
-        with trades_lock:
-            trade = trades.get(key) or trades.get(symbol)
-            if not trade:
-                return
-            if trade.get("exit_signal_received"):
-                print(f"[2-BAR] {symbol} → exit signal already received; skipping 2-bar check.")
-                return
-            # ensure still open and check flag entry_alert_received / entry_filled
-            entry_alert_received = trade.get("entry_alert_received", False)
-            entry_filled = trade.get("entry_filled", False)
+        # (read-only; single dict reads are atomic, so the symbol lock is not taken)
+        trade = resolve_trade(symbol, interval_str)
+        if not trade:
+            return
+        if trade.get("exit_signal_received"):
+            log.info(f"[2-BAR] {symbol} → exit signal already received; skipping 2-bar check.")
+            return
 
         # Check actual Binance position
         pos = get_position_info(symbol)
@@ -446,20 +941,20 @@ def two_bar_force_exit_worker(symbol, interval_str):
         except Exception:
             unrealized = 0.0
 
-        print(f"[2-BAR EVAL] {symbol} → unrealized_profit={unrealized}")
+        log.info(f"[2-BAR EVAL] {symbol} → unrealized_profit={unrealized}")
 
         # If unrealized < 0 => force market exit. else keep position open.
         if unrealized < 0:
             side = "BUY" if float(pos.get("positionAmt")) > 0 else "SELL"
-            print(f"[2-BAR FORCE] {symbol} → negative unrealized ({unrealized}) after 2 bars → forcing market exit.")
+            log.info(f"[2-BAR FORCE] {symbol} → negative unrealized ({unrealized}) after 2 bars → forcing market exit.")
             # call market exit (finalize_trade will cleanup)
             execute_market_exit(symbol, side, reason="2-Bar Force Exit")
         else:
             # Positive or zero unrealized -> do not force exit; keep position active
-            print(f"[2-BAR HOLD] {symbol} → unrealized >= 0 ({unrealized}). Keeping position open; awaiting exit signals.")
+            log.info(f"[2-BAR HOLD] {symbol} → unrealized >= 0 ({unrealized}). Keeping position open; awaiting exit signals.")
 
     except Exception as e:
-        print(f"❌ two_bar_force_exit_worker error for {symbol}: {e}")
+        log.error(f"❌ two_bar_force_exit_worker error for {symbol}: {e}", exc_info=True)
 
 
 # ===============================
@@ -479,7 +974,7 @@ def open_position(symbol, side, limit_price, interval="1m"):
         existing_side = "BUY" if float(pos_info.get("positionAmt")) > 0 else "SELL"
         # decide replace reason label
         replace_reason = "Replacing Entry: same direction signal" if existing_side == side.upper() else "Replacing Entry: opposite direction signal"
-        print(f"⚠️ Existing Binance position detected for {symbol} (side={existing_side}). Will close it first. Reason: {replace_reason}")
+        log.warning(f"⚠️ Existing Binance position detected for {symbol} (side={existing_side}). Will close it first. Reason: {replace_reason}")
 
         # Mark local trade (if exists) that we're replacing
         # Do NOT create new trade entry yet; ensure finalize_trade will use existing local state if present.
@@ -493,28 +988,29 @@ def open_position(symbol, side, limit_price, interval="1m"):
             time.sleep(1)
             cur = get_position_info(symbol)
             # check local trades cleared as well
-            with trades_lock:
-                any_local = any(k.startswith(f"{symbol}_") or k == symbol for k in trades.keys())
+            with trades_lock_for(symbol):
+                any_local = bool(symbol_keys(symbol))
             if (not cur or abs(float(cur.get("positionAmt", 0))) == 0) and not any_local:
                 cleared = True
                 break
 
         if not cleared:
-            print(f"⚠️ Position for {symbol} did not clear within {wait_timeout}s. Proceeding to attempt new entry anyway (risk of failure).")
+            log.warning(f"⚠️ Position for {symbol} did not clear within {wait_timeout}s. Proceeding to attempt new entry anyway (risk of failure).")
 
     # Now we may place the new entry (either there was no pre-existing position, or it's closed)
     active_count = count_active_trades()
     if active_count >= MAX_ACTIVE_TRADES:
-        print(f"🚫 Max active trades reached ({active_count}/{MAX_ACTIVE_TRADES})")
+        log.warning(f"🚫 Max active trades reached ({active_count}/{MAX_ACTIVE_TRADES})")
         return {"status": "max_trades_reached"}
 
     set_leverage_and_margin(symbol)
-    qty = calculate_quantity(symbol)
+    # sized at the alert's close (the limit price): no ticker call, only cached lot filters
+    qty = calculate_quantity(symbol, limit_price)
 
     key = trade_key(symbol, interval)
     # Initialize local trade placeholder - entry_filled False until we get a fill
-    with trades_lock:
-        trades[key] = {
+    with trades_lock_for(symbol):
+        trades_set(symbol, key, {
             "symbol": symbol,
             "side": side.upper(),
             "interval": interval,
@@ -526,7 +1022,7 @@ def open_position(symbol, side, limit_price, interval="1m"):
             "exit_signal_received": False,  # flag to avoid 2-bar forcing if exit came earlier
             "entry_alert_received": trades.get(key, {}).get("entry_alert_received", False),
             "bar_start_time": trades.get(key, {}).get("bar_start_time", None),
-        }
+        })
 
     # Place the limit order (do NOT send pending entry telegram; entry telegram will be sent when filled)
     response = binance_signed_request("POST", "/fapi/v1/order", {
@@ -535,22 +1031,22 @@ def open_position(symbol, side, limit_price, interval="1m"):
         "type": "LIMIT",
         "timeInForce": "GTC",
         "quantity": qty,
-        "price": limit_price
+        "price": round_price(symbol, limit_price)
     })
 
     # If order placed, monitor fill
     if isinstance(response, dict) and "orderId" in response:
+        invalidate_positions()
         order_id = response["orderId"]
         # update order id in local state
-        with trades_lock:
+        with trades_lock_for(symbol):
             if key in trades:
                 trades[key]["order_id"] = order_id
-        threading.Thread(target=wait_and_notify_filled_entry, args=(symbol, side, order_id, interval), daemon=True).start()
+        ENTRY_WAITERS.submit(wait_and_notify_filled_entry, symbol, side, order_id, interval)
     else:
         # If Binance rejected order or returned error, cleanup local placeholder
-        with trades_lock:
-            if key in trades:
-                trades.pop(key, None)
+        with trades_lock_for(symbol):
+            trades_pop(symbol, key)
 
     return response
 
@@ -561,19 +1057,28 @@ def wait_and_notify_filled_entry(symbol, side, order_id, interval="1m"):
     with actual Binance fill price and start the 2-bar force-exit worker.
     """
     notified = False
+    filled_qty = 0.0
+    final = False  # set once the deadline is reached; the next pass is the last
+    # The waiter stops after ENTRY_WAIT_TIMEOUT_BARS. Cancelling the resting order on Binance is
+    # opt-in (ENTRY_ORDER_TIMEOUT_BARS > 0, which then also sets the deadline).
+    cancel_on_timeout = ENTRY_ORDER_TIMEOUT_BARS > 0
+    timeout_sec = (ENTRY_ORDER_TIMEOUT_BARS if cancel_on_timeout else ENTRY_WAIT_TIMEOUT_BARS) * interval_to_seconds(interval)
+    deadline = time.time() + timeout_sec if timeout_sec > 0 else None
+    order_params = {"symbol": symbol, "orderId": order_id}
     try:
         key = trade_key(symbol, interval)
+        order_status = binance_signed_request("GET", "/fapi/v1/order", order_params)
         while True:
-            order_status = binance_signed_request("GET", "/fapi/v1/order", {"symbol": symbol, "orderId": order_id})
             status = order_status.get("status")
             executed_qty = float(order_status.get("executedQty", 0) or 0)
             # avgPrice may be string "0" for unfilled; fallback accordingly
             avg_price = float(order_status.get("avgPrice") or order_status.get("price") or 0)
 
-            if not notified and status in ("PARTIALLY_FILLED", "FILLED") and executed_qty > 0:
+            # executedQty > 0 also covers an order partly filled and then cancelled at the deadline
+            if not notified and executed_qty > 0:
                 # Mark entry as filled and update entry price/time
-                with trades_lock:
-                    trade = trades.get(key, {})
+                with trades_lock_for(symbol):
+                    trade = trades_setdefault(symbol, key)
                     trade["entry_filled"] = True
                     trade["entry_price"] = avg_price
                     trade["entry_time"] = time.time()
@@ -584,9 +1089,8 @@ def wait_and_notify_filled_entry(symbol, side, order_id, interval="1m"):
                     # Some workers check trades.get(symbol) (no interval). Create/update that fallback
                     # to avoid race/key-mismatch issues where the 2-bar worker can't find the filled entry.
                     fallback_key = symbol  # plain symbol fallback
-                    trades[fallback_key] = trades.get(fallback_key, {})
                     # copy important fields across (shallow copy is fine)
-                    trades[fallback_key].update({
+                    trades_setdefault(symbol, fallback_key).update({
                         "symbol": trade.get("symbol"),
                         "side": trade.get("side"),
                         "entry_price": trade.get("entry_price"),
@@ -603,20 +1107,54 @@ def wait_and_notify_filled_entry(symbol, side, order_id, interval="1m"):
 
                 # Send single entry notification (actual Binance price)
                 log_trade_entry(symbol, side, avg_price, order_id=order_id, interval=interval)
-                print(f"[ENTRY FILLED] {symbol} {side} @ {avg_price} ({interval})")
+                log.info(f"[ENTRY FILLED] {symbol} {side} @ {avg_price} ({interval})")
                 notified = True
-
-                # Start 2-bar force exit thread once per trade if not already started by alert
-                with trades_lock:
-                    if not trades.get(key, {}).get("two_bar_thread_started"):
-                        trades[key]["two_bar_thread_started"] = True
-                        threading.Thread(target=two_bar_force_exit_worker, args=(symbol, interval), daemon=True).start()
-
-            if status in ("FILLED", "CANCELED", "REJECTED", "EXPIRED"):
+                filled_qty = executed_qty
+
+                # Schedule 2-bar force exit check once per trade if not already started by alert
+                with trades_lock_for(symbol):
+                    trade = trades_setdefault(symbol, key)
+                    if not trade.get("two_bar_thread_started"):
+                        trade["two_bar_thread_started"] = True
+                        schedule_two_bar_check(symbol, interval, trade.get("bar_start_time") or trade.get("entry_time"))
+
+            elif notified and executed_qty > filled_qty:
+                # further fills after the entry alert: keep the tracked size/price current
+                filled_qty = executed_qty
+                with trades_lock_for(symbol):
+                    for k in (key, symbol):
+                        if k in trades:
+                            trades[k]["position_qty"] = executed_qty
+                            trades[k]["entry_price"] = avg_price
+
+            if final or status in ("FILLED", "CANCELED", "REJECTED", "EXPIRED"):
                 break
-            time.sleep(1)
+            remaining = deadline - time.time() if deadline else ORDER_STREAM_FALLBACK_SEC
+            if remaining <= 0:
+                cancel = None
+                if cancel_on_timeout:
+                    # stale signal: cancel whatever still rests (the whole order, or the unfilled
+                    # remainder of a partial fill) rather than leave it on the book unwatched
+                    cancel = binance_signed_request("DELETE", "/fapi/v1/order", order_params)
+                if cancel and cancel.get("status") == "CANCELED":
+                    order_status = cancel
+                    log.warning(f"⌛ Entry order {order_id} for {symbol} not fully filled after {timeout_sec}s → "
+                                f"cancelled (filled {cancel.get('executedQty', 0)}).")
+                else:
+                    # not cancelling, or cancel refused (e.g. -2011, filled in the meantime): take
+                    # the order's latest state
+                    order_status = binance_signed_request("GET", "/fapi/v1/order", order_params)
+                    if not cancel_on_timeout:
+                        log.warning(f"⌛ Entry order {order_id} for {symbol} still {order_status.get('status')} after "
+                                    f"{timeout_sec}s → no longer watched (order left on Binance).")
+                # one more pass so a fill that landed before the deadline is recorded and notified
+                final = True
+                continue
+            order_status = wait_order_update(symbol, order_id, min(remaining, ORDER_STREAM_FALLBACK_SEC), order_params)
     except Exception as e:
-        print(f"❌ wait_and_notify_filled_entry error for {symbol}: {e}")
+        log.error(f"❌ wait_and_notify_filled_entry error for {symbol}: {e}", exc_info=True)
+    finally:
+        release_order_slot(order_id)
 
 
 # ===============================
@@ -636,28 +1174,23 @@ def evaluate_exit_signal(symbol, alert_close_price, alert_side, bar_high=None, b
         pos = get_position_info(symbol)
         if not pos or abs(float(pos.get("positionAmt", 0))) == 0:
             # No Binance position — we will NOT reset local 2-bar state here.
-            print(f"⚠️ evaluate_exit_signal: no active position for {symbol} according to Binance. Ignoring exit alert for now (no reset).")
+            log.warning(f"⚠️ evaluate_exit_signal: no active position for {symbol} according to Binance. Ignoring exit alert for now (no reset).")
             return {"status": "no_position_binance"}
 
         # If we have a Binance position, proceed to close
         side = "BUY" if float(pos.get("positionAmt", 0)) > 0 else "SELL"
 
         # choose interval from local state if available, and mark exit_signal_received so worker skips forcing
-        interval = interval_hint
-        with trades_lock:
-            for k in trades.keys():
-                if k.startswith(f"{symbol}_"):
-                    interval = k.split("_", 1)[1]
-                    break
+        with trades_lock_for(symbol):
+            interval = symbol_interval(symbol, interval_hint)
             # mark exit signal received so 2-bar worker will skip
             key = trade_key(symbol, interval)
             if key in trades:
                 trades[key]["exit_signal_received"] = True
             else:
                 # also mark any matching symbol key without interval
-                for k in list(trades.keys()):
-                    if k.startswith(f"{symbol}_") or k == symbol:
-                        trades[k]["exit_signal_received"] = True
+                for k in symbol_keys(symbol):
+                    trades[k]["exit_signal_received"] = True
 
         # attempt exit (limit -> market)
         reason_label = "Exit Signal"
@@ -669,96 +1202,202 @@ def evaluate_exit_signal(symbol, alert_close_price, alert_side, bar_high=None, b
             return {"status": "exit_signal_market_called"}
 
     except Exception as e:
-        print(f"❌ evaluate_exit_signal error for {symbol}: {e}")
+        log.error(f"❌ evaluate_exit_signal error for {symbol}: {e}", exc_info=True)
         return {"error": str(e)}
 
 
+# ===============================
+# Webhook Signal Handlers
+# ===============================
+# All handlers take (symbol, comment, close_price, bar_high, bar_low, interval) and
+# return the JSON-able result for the webhook response.
+def handle_entry_signal(symbol, comment, close_price, bar_high, bar_low, interval):
+    # Record entry alert time and start the 2-bar counter from the alert time
+    with trades_lock_for(symbol):
+        k = trade_key(symbol, interval)
+        trades_setdefault(symbol, k)
+        trades[k]["entry_alert_received"] = True
+        trades[k]["bar_start_time"] = time.time()
+        # also ensure fallback symbol key exists (keeps parity for workers)
+        trades_setdefault(symbol, symbol).update({
+            "entry_alert_received": True,
+            "bar_start_time": trades[k]["bar_start_time"],
+            "interval": interval
+        })
+        # schedule 2-bar check immediately on alert (only once)
+        if not trades[k].get("two_bar_thread_started"):
+            trades[k]["two_bar_thread_started"] = True
+            schedule_two_bar_check(symbol, interval, trades[k]["bar_start_time"])
+
+    side = "BUY" if comment == "BUY_ENTRY" else "SELL"
+    return open_position(symbol, side, close_price, interval=interval)
+
+
+CLOSE_SIGNAL_REASONS = {
+    "CROSS_EXIT_SHORT": "Cross Exit",
+    "CROSS_EXIT_LONG": "Cross Exit",
+    "OPPOSITE_EXIT": "Opposite Exit",
+    "SAME_SIDE_EXIT": "Same Side Exit",
+}
+
+
+def handle_close_signal(symbol, comment, close_price, bar_high, bar_low, interval):
+    """CROSS / OPPOSITE / SAME-SIDE signals => immediate close regardless of PnL."""
+    pos = get_position_info(symbol)
+    if pos and abs(float(pos.get("positionAmt", 0))) > 0:
+        side = "BUY" if float(pos.get("positionAmt")) > 0 else "SELL"
+        reason_label = CLOSE_SIGNAL_REASONS[comment]
+        # mark exit_signal_received for local trade if present and clear 2-bar tracking after exit
+        with trades_lock_for(symbol):
+            for k in symbol_keys(symbol):
+                trades[k]["exit_signal_received"] = True
+        # attempt limit->market if provided
+        if USE_BAR_HIGH_LOW_FOR_EXIT and bar_high and bar_low:
+            execute_exit(symbol, side, interval=interval, bar_high=bar_high, bar_low=bar_low, reason=reason_label)
+        else:
+            execute_market_exit(symbol, side, reason=reason_label)
+        # do not reset 2-bar state here; allow finalize_trade to clean after confirmed Binance exit
+        return {"status": "closed_by_opposite_same_cross"}
+    # no Binance position — keep local state (don't reset). User may want fallback behavior.
+    log.info(f"[WEBHOOK] No Binance position for {symbol} on CROSS/OPPOSITE/SAME signal -> nothing to close.")
+    return {"status": "no_position"}
+
+
+def handle_exit_signal(symbol, comment, close_price, bar_high, bar_low, interval):
+    """EXIT signals (informational; but now they close Binance position if it exists)."""
+    return evaluate_exit_signal(symbol, close_price, comment, bar_high, bar_low, interval_hint=interval)
+
+
+WEBHOOK_HANDLERS = {
+    "BUY_ENTRY": handle_entry_signal,
+    "SELL_ENTRY": handle_entry_signal,
+    **{comment: handle_close_signal for comment in CLOSE_SIGNAL_REASONS},
+    "EXIT_LONG": handle_exit_signal,
+    "EXIT_SHORT": handle_exit_signal,
+    "SIGNAL_EXIT": handle_exit_signal,
+}
+
+
 # ===============================
 # Webhook Endpoint
 # ===============================
+# TradingView can deliver the same alert twice on bar close; each copy would otherwise run a
+# full entry/exit (several signed calls and a second order).
+_last_signal = {}  # (symbol, comment, interval) -> monotonic time of last accepted alert
+_last_signal_lock = threading.Lock()
+
+
+def is_duplicate_signal(symbol, comment, interval):
+    """True if the same alert was accepted within WEBHOOK_DEDUP_SEC; otherwise record it."""
+    if WEBHOOK_DEDUP_SEC <= 0:
+        return False
+    fp = (symbol, comment, interval)
+    now = time.monotonic()
+    with _last_signal_lock:
+        last = _last_signal.get(fp)
+        if last is not None and now - last < WEBHOOK_DEDUP_SEC:
+            return True
+        _last_signal[fp] = now
+    return False
+
+
+def forget_signal(symbol, comment, interval):
+    """Un-record an alert that was not processed, so a retry is not treated as a duplicate."""
+    with _last_signal_lock:
+        _last_signal.pop((symbol, comment, interval), None)
+
+
+# With ASYNC_WEBHOOK the request thread only parses and acks; handlers run on WEBHOOK_POOL.
+# Each symbol has its own FIFO drained by at most one pool thread at a time, so a symbol's
+# alerts run in arrival order (entry before its exit) while a slow handler only ever delays
+# later alerts for that same symbol. Queued (not yet running) alerts are capped at
+# WEBHOOK_QUEUE_MAX.
+WEBHOOK_POOL = ThreadPoolExecutor(max_workers=max(WEBHOOK_WORKERS, 1), thread_name_prefix="webhook")
+_webhook_queues = {}   # symbol -> deque of pending handler args; present while a drain is scheduled
+_webhook_queued = 0    # pending jobs across all symbols
+_webhook_lock = threading.Lock()
+
+
+def enqueue_webhook(symbol, job):
+    """Queue job (run_webhook_handler args) behind earlier alerts for symbol. False if the backlog is full."""
+    global _webhook_queued
+    with _webhook_lock:
+        if _webhook_queued >= WEBHOOK_QUEUE_MAX:
+            return False
+        _webhook_queued += 1
+        pending = _webhook_queues.get(symbol)
+        if pending is not None:
+            pending.append(job)  # the running drain for this symbol will pick it up
+            return True
+        _webhook_queues[symbol] = deque((job,))
+    WEBHOOK_POOL.submit(_drain_webhook_queue, symbol)
+    return True
+
+
+def _drain_webhook_queue(symbol):
+    global _webhook_queued
+    while True:
+        with _webhook_lock:
+            pending = _webhook_queues[symbol]
+            if not pending:
+                del _webhook_queues[symbol]
+                return
+            job = pending.popleft()
+            _webhook_queued -= 1
+        run_webhook_handler(*job)
+
+
+def run_webhook_handler(handler, symbol, comment, close_price, bar_high, bar_low, interval):
+    try:
+        result = handler(symbol, comment, close_price, bar_high, bar_low, interval)
+        log.info(f"[WEBHOOK] {comment} {symbol} ({interval}) → {result}")
+    except Exception as e:
+        log.error(f"❌ Webhook handler error for {symbol} ({comment}): {e}", exc_info=True)
+
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
     data = request.get_data(as_text=True)
     try:
-        parts = [p.strip() for p in data.split("|")]
-        if len(parts) >= 6:
-            ticker, comment, close_price, bar_high, bar_low, interval = parts[:6]
+        m = _WEBHOOK_RE.fullmatch(data)
+        if m:
+            ticker, comment, close_price, bar_high, bar_low, interval = m.groups()
         else:
-            # fallback formats
-            ticker, comment, close_price, interval = parts[0], parts[1], parts[2], parts[-1]
+            # fallback formats (ticker|comment|close|interval); float() and normalize_interval()
+            # tolerate surrounding whitespace, so only ticker and comment are stripped
+            parts = data.split("|")
+            ticker, comment, close_price, interval = parts[0].strip(), parts[1].strip(), parts[2], parts[-1]
             bar_high = bar_low = None
 
+        # reject unknown comments before any parsing or local state is created for them
+        handler = WEBHOOK_HANDLERS.get(comment)
+        if handler is None:
+            return json_response({"error": f"Unknown comment: {comment}"})
+
         interval = normalize_interval(interval)
-        symbol = ticker.replace("USDT", "") + "USDT"
+        symbol = canonical_symbol(ticker)
         close_price = float(close_price)
 
+        if is_duplicate_signal(symbol, comment, interval):
+            log.info(f"[WEBHOOK] Duplicate {comment} for {symbol} ({interval}) within {WEBHOOK_DEDUP_SEC}s → ignored")
+            return json_response({"status": "deduped"})
+
         # initialize interval placeholder in trades state
-        with trades_lock:
+        with trades_lock_for(symbol):
             k = trade_key(symbol, interval)
-            trades.setdefault(k, {})
-            trades[k]["interval"] = interval
-
-        # ENTRY signals
-        if comment == "BUY_ENTRY" or comment == "SELL_ENTRY":
-            # Record entry alert time and start the 2-bar counter from the alert time
-            with trades_lock:
-                k = trade_key(symbol, interval)
-                trades.setdefault(k, {})
-                trades[k]["entry_alert_received"] = True
-                trades[k]["bar_start_time"] = time.time()
-                # also ensure fallback symbol key exists (keeps parity for workers)
-                trades.setdefault(symbol, {})
-                trades[symbol].update({
-                    "entry_alert_received": True,
-                    "bar_start_time": trades[k]["bar_start_time"],
-                    "interval": interval
-                })
-                # start 2-bar thread immediately on alert (only once)
-                if not trades[k].get("two_bar_thread_started"):
-                    trades[k]["two_bar_thread_started"] = True
-                    threading.Thread(target=two_bar_force_exit_worker, args=(symbol, interval), daemon=True).start()
-
-            # call open_position
-            if comment == "BUY_ENTRY":
-                return jsonify(open_position(symbol, "BUY", close_price, interval=interval))
-            else:
-                return jsonify(open_position(symbol, "SELL", close_price, interval=interval))
+            trades_setdefault(symbol, k)["interval"] = interval
 
-        # CROSS / OPPOSITE / SAME-SIDE signals => immediate close regardless of PnL
-        elif comment in ["CROSS_EXIT_SHORT", "CROSS_EXIT_LONG", "OPPOSITE_EXIT", "SAME_SIDE_EXIT"]:
-            pos = get_position_info(symbol)
-            if pos and abs(float(pos.get("positionAmt", 0))) > 0:
-                side = "BUY" if float(pos.get("positionAmt")) > 0 else "SELL"
-                # Map reason label
-                reason_label = "Cross Exit" if comment.startswith("CROSS") else ("Opposite Exit" if comment == "OPPOSITE_EXIT" else "Same Side Exit")
-                # mark exit_signal_received for local trade if present and clear 2-bar tracking after exit
-                with trades_lock:
-                    for k in list(trades.keys()):
-                        if k.startswith(f"{symbol}_") or k == symbol:
-                            trades[k]["exit_signal_received"] = True
-                # attempt limit->market if provided
-                if USE_BAR_HIGH_LOW_FOR_EXIT and bar_high and bar_low:
-                    execute_exit(symbol, side, interval=interval, bar_high=bar_high, bar_low=bar_low, reason=reason_label)
-                else:
-                    execute_market_exit(symbol, side, reason=reason_label)
-                # do not reset 2-bar state here; allow finalize_trade to clean after confirmed Binance exit
-                return jsonify({"status": "closed_by_opposite_same_cross"})
-            else:
-                # no Binance position — keep local state (don't reset). User may want fallback behavior.
-                print(f"[WEBHOOK] No Binance position for {symbol} on CROSS/OPPOSITE/SAME signal -> nothing to close.")
-                return jsonify({"status": "no_position"})
-
-        # EXIT signals (informational; but now they close Binance position if it exists)
-        elif comment in ["EXIT_LONG", "EXIT_SHORT", "SIGNAL_EXIT"]:
-            result = evaluate_exit_signal(symbol, close_price, comment, bar_high, bar_low, interval_hint=interval)
-            return jsonify(result)
-
-        else:
-            return jsonify({"error": f"Unknown comment: {comment}"})
+        if ASYNC_WEBHOOK:
+            if not enqueue_webhook(symbol, (handler, symbol, comment, close_price, bar_high, bar_low, interval)):
+                forget_signal(symbol, comment, interval)
+                log.warning(f"⚠️ Webhook backlog full ({WEBHOOK_QUEUE_MAX}) → rejected {comment} for {symbol}")
+                return json_response({"error": "webhook backlog full"}, status=503)
+            return json_response({"status": "accepted"})
+        return json_response(handler(symbol, comment, close_price, bar_high, bar_low, interval))
 
     except Exception as e:
-        print("❌ Webhook Error:", e)
-        return jsonify({"error": str(e)})
+        log.error(f"❌ Webhook Error: {e}", exc_info=True)
+        return json_response({"error": str(e)})
 
 
 # ===============================
@@ -769,17 +1408,31 @@ def ping():
     return "pong", 200
 
 
+# Separate from the Binance SESSION: the ping goes to a public host and must never share
+# Binance headers or connection state with it.
+PING_SESSION = requests.Session()
+
+
 def self_ping():
-    while True:
-        try:
-            requests.get(os.getenv("SELF_PING_URL", "https://binance-wcc-tradingview.onrender.com/ping"))
-        except:
-            pass
-        time.sleep(5 * 60)
+    """Keep the free Render instance awake; re-queued on the shared scheduler (no sleeping thread)."""
+    try:
+        PING_SESSION.head(SELF_PING_URL, timeout=HTTP_TIMEOUT)  # Flask answers HEAD on GET routes; no body
+    except Exception:
+        pass
+    schedule_in(SELF_PING_INTERVAL_SEC + random.uniform(0, 30), self_ping)
+
 
+if ENABLE_SELF_PING:
+    schedule_in(0, self_ping)
+threading.Thread(target=order_status_poller, name="order-poller", daemon=True).start()
 
-threading.Thread(target=self_ping, daemon=True).start()
+if USE_USER_DATA_STREAM and websocket is not None and BINANCE_API_KEY:
+    threading.Thread(target=user_data_stream, daemon=True).start()
+    threading.Thread(target=listen_key_keepalive, daemon=True).start()
+elif USE_USER_DATA_STREAM:
+    log.warning("⚠️ User data stream unavailable (websocket-client or API key missing) → using REST polling")
 
 if __name__ == "__main__":
+    # Local development only; production runs `gunicorn wsgi:app` (see gunicorn.conf.py)
     port = int(os.getenv("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
+    app.run(host="0.0.0.0", port=port, threaded=True)
@@ -2,7 +2,12 @@
 # config.py (Final Integrated)
 # ==============================
 
+import atexit
+import logging
 import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
 
 # ==============================
 # 🔹 BINANCE CONFIGURATION
@@ -17,14 +22,28 @@ LIVE_SECRET_KEY    = os.getenv("LIVE_SECRET_KEY")
 TESTNET_BASE_URL   = "https://testnet.binancefuture.com"
 LIVE_BASE_URL      = "https://fapi.binance.com"
 
+TESTNET_WS_BASE_URL = "wss://stream.binancefuture.com"
+LIVE_WS_BASE_URL    = "wss://fstream.binance.com"
+
 if USE_TESTNET:
     BINANCE_API_KEY    = TESTNET_API_KEY
     BINANCE_SECRET_KEY = TESTNET_SECRET_KEY
     BASE_URL           = TESTNET_BASE_URL
+    WS_BASE_URL        = TESTNET_WS_BASE_URL
 else:
     BINANCE_API_KEY    = LIVE_API_KEY
     BINANCE_SECRET_KEY = LIVE_SECRET_KEY
     BASE_URL           = LIVE_BASE_URL
+    WS_BASE_URL        = LIVE_WS_BASE_URL
+
+# User Data Stream (order fills pushed over websocket; REST polling is the fallback)
+USE_USER_DATA_STREAM     = os.getenv("USE_USER_DATA_STREAM", "True") == "True"
+LISTEN_KEY_KEEPALIVE_SEC = int(os.getenv("LISTEN_KEY_KEEPALIVE_SEC", "1800"))  # Binance expires keys after 60m
+ORDER_STREAM_FALLBACK_SEC = int(os.getenv("ORDER_STREAM_FALLBACK_SEC", "15"))  # Max wait on stream before a REST check
+ORDER_POLL_INTERVAL      = float(os.getenv("ORDER_POLL_INTERVAL", "0.5"))  # REST fallback poller tick (stream down)
+EXIT_ORDER_TIMEOUT_SEC   = int(os.getenv("EXIT_ORDER_TIMEOUT_SEC", "120"))  # Stop waiting on a market exit fill
+ENTRY_WAIT_TIMEOUT_BARS  = int(os.getenv("ENTRY_WAIT_TIMEOUT_BARS", "2"))  # Stop watching an unfilled entry after N bars (0 = never)
+ENTRY_ORDER_TIMEOUT_BARS = int(os.getenv("ENTRY_ORDER_TIMEOUT_BARS", "0"))  # Opt-in: cancel unfilled entry on Binance after N bars (0 = never)
 
 
 # ==============================
@@ -35,6 +54,12 @@ LEVERAGE            = int(os.getenv("LEVERAGE", "20"))         # Leverage multip
 MARGIN_TYPE         = os.getenv("MARGIN_TYPE", "ISOLATED")     # CROSS or ISOLATED
 MAX_ACTIVE_TRADES   = int(os.getenv("MAX_ACTIVE_TRADES", "5")) # Limit active trades
 OPPOSITE_CLOSE_DELAY = int(os.getenv("OPPOSITE_CLOSE_DELAY", "3")) # Delay between opposite close & new entry
+WEBHOOK_DEDUP_SEC   = float(os.getenv("WEBHOOK_DEDUP_SEC", "2"))  # Drop repeats of the same alert within this window (0 = off)
+ASYNC_WEBHOOK       = os.getenv("ASYNC_WEBHOOK", "True") == "True"  # Ack alerts at once, trade in background
+WEBHOOK_WORKERS     = int(os.getenv("WEBHOOK_WORKERS", "16"))    # Symbols whose alerts can be processed at once
+WEBHOOK_QUEUE_MAX   = int(os.getenv("WEBHOOK_QUEUE_MAX", "1000")) # Max queued alerts before rejecting with 503
+WORKER_THREADS      = int(os.getenv("WORKER_THREADS", "32"))     # Pool size for exit waiters / 2-bar checks
+ENTRY_WAITER_THREADS = int(os.getenv("ENTRY_WAITER_THREADS", "32"))  # Pool size for resting entry order waiters
 
 
 # ==============================
@@ -59,11 +84,33 @@ TELEGRAM_CHAT_ID   = os.getenv("TELEGRAM_CHAT_ID", "-1003281678423")
 DAILY_SUMMARY_TIME_IST = os.getenv("DAILY_SUMMARY_TIME_IST", "00:00")
 
 
+# ==============================
+# 🔹 KEEP-ALIVE (Render free tier sleeps when idle)
+# ==============================
+ENABLE_SELF_PING       = os.getenv("ENABLE_SELF_PING", "True") == "True"
+SELF_PING_URL          = os.getenv("SELF_PING_URL", "https://binance-wcc-tradingview.onrender.com/ping")
+SELF_PING_INTERVAL_SEC = int(os.getenv("SELF_PING_INTERVAL_SEC", "600"))  # Render sleeps after 15m idle
+
+
 # ==============================
 # 🔹 LOGGING
 # ==============================
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")  # INFO, DEBUG, ERROR
 
+# Worker threads only enqueue records; one listener thread does the blocking stdout writes,
+# so order waiters / the poller never serialize on the stdout lock.
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("%(message)s"))
+_log_listener = QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)  # flush queued records on shutdown
+
+log = logging.getLogger("bot")
+log.setLevel(getattr(logging, LOG_LEVEL.upper(), logging.INFO))
+log.addHandler(QueueHandler(_log_queue))
+log.propagate = False
+
 
 # ==============================
 # 🔹 CONFIG SUMMARY
@@ -79,5 +126,8 @@ Bar Exit Timeout:        {BAR_EXIT_TIMEOUT_SEC}s
 Market Exit Delay:       {EXIT_MARKET_DELAY if EXIT_MARKET_DELAY_ENABLED else 'Disabled'}
 Opposite Close Delay:    {OPPOSITE_CLOSE_DELAY}s
 Max Active Trades:       {MAX_ACTIVE_TRADES}
+User Data Stream:        {USE_USER_DATA_STREAM}
+Async Webhook:           {f"{WEBHOOK_WORKERS} workers" if ASYNC_WEBHOOK else 'Disabled'}
+Self Ping:               {SELF_PING_INTERVAL_SEC if ENABLE_SELF_PING else 'Disabled'}
 ------------------------------
 """)
@@ -0,0 +1,21 @@
+# ==============================
+# gunicorn.conf.py
+# ==============================
+# Picked up automatically by `gunicorn wsgi:app` (run from the repo root).
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# One process: trades state, order slots, the user data stream and schedulers all live
+# in-process memory, so a second worker would split state and double the background
+# threads. Concurrency comes from gthread threads instead.
+workers = 1
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "8"))
+
+# No preload: background threads are started at import and would not survive the fork.
+preload_app = False
+
+timeout = 60
+keepalive = 5
@@ -5,31 +5,84 @@
 import threading
 import time
 import requests
-from config import TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, TRADE_AMOUNT, LEVERAGE
+from config import TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, TRADE_AMOUNT, LEVERAGE, log
 
 # ==============================
 # 🧾 SHARED STORAGE
 # ==============================
 trades = {}
-trades_lock = threading.Lock()
+
+# Striped locks: every trades access is per-symbol, so alerts for different symbols
+# don't serialize on one global lock. Same symbol -> same (re-entrant) lock.
+TRADE_LOCK_STRIPES = 64
+_trade_locks = [threading.RLock() for _ in range(TRADE_LOCK_STRIPES)]
+
+
+def trades_lock_for(symbol: str):
+    return _trade_locks[hash(symbol) % TRADE_LOCK_STRIPES]
+
+
+# symbol -> {trades key: None} (insertion-ordered set of interval keys + plain-symbol fallback)
+# Lets per-symbol lookups/cleanup skip scanning every key in `trades`.
+# All helpers below expect the caller to hold trades_lock_for(symbol).
+symbol_index = {}
+
+
+def trades_set(symbol: str, key: str, value: dict):
+    trades[key] = value
+    symbol_index.setdefault(symbol, {})[key] = None
+
+
+def trades_setdefault(symbol: str, key: str) -> dict:
+    if key not in trades:
+        trades_set(symbol, key, {})
+    return trades[key]
+
+
+def trades_pop(symbol: str, key: str):
+    keys = symbol_index.get(symbol)
+    if keys is not None:
+        keys.pop(key, None)
+        if not keys:
+            symbol_index.pop(symbol, None)
+    return trades.pop(key, None)
+
+
+def symbol_keys(symbol: str) -> list:
+    """All trades keys belonging to symbol (interval keys and plain-symbol fallback)."""
+    return list(symbol_index.get(symbol, ()))
+
+
+def symbol_interval(symbol: str, default: str = None):
+    """Interval of the first interval-keyed trade for symbol, else default."""
+    for k in symbol_index.get(symbol, ()):
+        if k != symbol:
+            # keys are f"{symbol}_{interval}": slice past the known prefix (no list, and
+            # correct for dated contracts like BTCUSDT_250627 that contain "_" themselves)
+            return k[len(symbol) + 1:]
+    return default
 
 
 # ==============================
 # 📢 TELEGRAM HELPER
 # ==============================
+# Keep-alive session: every alert reuses the TLS connection to api.telegram.org
+telegram_session = requests.Session()
+
+
 def send_telegram_message(message: str):
     """Send Telegram message via bot token"""
     try:
         if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
-            print("⚠️ Missing Telegram credentials, skipping message.")
+            log.warning("⚠️ Missing Telegram credentials, skipping message.")
             return
         url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
         payload = {"chat_id": TELEGRAM_CHAT_ID, "text": message, "parse_mode": "HTML"}
-        response = requests.post(url, data=payload, timeout=10)
+        response = telegram_session.post(url, data=payload, timeout=10)
         if response.status_code != 200:
-            print(f"⚠️ Telegram error: {response.text}")
+            log.warning(f"⚠️ Telegram error: {response.text}")
     except Exception as e:
-        print(f"❌ Telegram exception: {e}")
+        log.error(f"❌ Telegram exception: {e}", exc_info=True)
 
 # ==============================
 # 🟩 LOG TRADE ENTRY (FILLED ONLY)
@@ -38,8 +91,8 @@ def log_trade_entry(symbol: str, side: str, filled_price: float, order_id: str =
     """Store entry data + send Telegram alert only when actual trade is filled on Binance"""
     key = f"{symbol}_{interval.lower()}"
 
-    with trades_lock:
-        trades[key] = {
+    with trades_lock_for(symbol):
+        trades_set(symbol, key, {
             "symbol": symbol,
             "side": side.upper(),
             "entry_price": filled_price,
@@ -47,7 +100,7 @@ def log_trade_entry(symbol: str, side: str, filled_price: float, order_id: str =
             "interval": interval.lower(),
             "closed": False,
             "entry_time": time.time(),
-        }
+        })
 
     arrow = "⬆️" if side.upper() == "BUY" else "⬇️"
     trade_type = "Long Trade" if side.upper() == "BUY" else "Short Trade"
@@ -64,7 +117,7 @@ Entry Price: <b>{filled_price}</b>
 --- ⌁ ---
 🕐 Trade Opened on Binance"""
     send_telegram_message(msg)
-    print(f"[ENTRY FILLED] {symbol} {side.upper()} @ {filled_price} ({interval})")
+    log.info(f"[ENTRY FILLED] {symbol} {side.upper()} @ {filled_price} ({interval})")
 
 
 # ==============================
@@ -78,12 +131,17 @@ def log_trade_exit(
     reason: str = "Exit",
     interval: str = "1m",
     order_id: str | None = None,
+    fallback_entry_price: float | None = None,
 ):
-    """Store exit + send Telegram alert (always show entry, with leverage-based %)"""
+    """
+    Store exit + send Telegram alert (always show entry, with leverage-based %).
+    fallback_entry_price (e.g. Binance positionRisk entryPrice, fetched by the caller) is shown
+    when no open local trade is found.
+    """
     key = f"{symbol}_{interval.lower()}"
     entry_price = None
 
-    with trades_lock:
+    with trades_lock_for(symbol):
         trade = trades.get(key)
         if trade and not trade.get("closed"):
             entry_price = trade.get("entry_price")
@@ -92,23 +150,8 @@ def log_trade_exit(
             trade["pnl_percent"] = pnl_percent
             trade["closed"] = True
         else:
-            print(f"⚠️ log_trade_exit: no active trade found for {symbol}")
-            # 🧭 fallback - try retrieving last known entry from Binance API
-            try:
-                import requests
-                from config import BINANCE_API_KEY, BINANCE_API_SECRET
-
-                url = "https://fapi.binance.com/fapi/v2/positionRisk"
-                headers = {"X-MBX-APIKEY": BINANCE_API_KEY}
-                res = requests.get(url, headers=headers, timeout=10)
-                if res.status_code == 200:
-                    positions = res.json()
-                    for p in positions:
-                        if p["symbol"].upper() == symbol.upper() and float(p["positionAmt"]) != 0:
-                            entry_price = float(p["entryPrice"])
-                            break
-            except Exception as e:
-                print(f"⚠️ Binance entry fetch failed: {e}")
+            log.warning(f"⚠️ log_trade_exit: no active trade found for {symbol}")
+            entry_price = fallback_entry_price
 
     # Use placeholder if nothing found
     entry_price_display = entry_price if entry_price else "?"
@@ -132,16 +175,22 @@ Exit: {filled_price}"""
         msg += f"\nOrder ID: <b>{order_id}</b>"
 
     send_telegram_message(msg)
-    print(f"[EXIT] {symbol} closed @ {filled_price} | Entry={entry_price_display} | PnL: {pnl}$ ({leveraged_pnl_percent}%) | Reason: {reason}")
+    log.info(f"[EXIT] {symbol} closed @ {filled_price} | Entry={entry_price_display} | PnL: {pnl}$ ({leveraged_pnl_percent}%) | Reason: {reason}")
 
 
 # ==============================
 # ⏱️ INTERVAL TO SECONDS
 # ==============================
+INTERVAL_SECONDS = {
+    "1m": 60, "3m": 180, "5m": 300, "15m": 900,
+    "30m": 1800, "1h": 3600, "2h": 7200,
+    "4h": 14400, "1d": 86400
+}
+
+
 def interval_to_seconds(interval: str) -> int:
-    mapping = {
-        "1m": 60, "3m": 180, "5m": 300, "15m": 900,
-        "30m": 1800, "1h": 3600, "2h": 7200,
-        "4h": 14400, "1d": 86400
-    }
-    return mapping.get(interval.lower(), 60)
+    # intervals arrive already normalized (lowercase) from the webhook; only lower() on a miss
+    seconds = INTERVAL_SECONDS.get(interval)
+    if seconds is None:
+        seconds = INTERVAL_SECONDS.get(interval.lower(), 60)
+    return seconds
@@ -0,0 +1,6 @@
+# ==============================
+# wsgi.py - gunicorn entry point
+# ==============================
+# gunicorn wsgi:app   (settings in gunicorn.conf.py)
+
+from app import app  # noqa: F401